@@ -3,9 +3,94 @@
 #
 # Copyright (C) 2022 Université Gustave Eiffel
 
+import contextlib
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import ot
-# TODO change ot dep to scipy. Only used for matrix building now.
+
+try:
+    import numba
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    # numba is optional: without it, the compiled kernels below are never called
+    # and sinkhorn_map falls back to its numpy implementation.
+    _HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+    prange = range
+
+try:
+    import numexpr
+    _HAS_NUMEXPR = True
+except ImportError:
+    _HAS_NUMEXPR = False
+
+try:
+    import jax
+    import jax.numpy as jnp
+    from jax.scipy.special import logsumexp as jax_logsumexp
+    _HAS_JAX = True
+except ImportError:
+    # jax is optional, only needed for hurot(..., backend="jax").
+    _HAS_JAX = False
+
+try:
+    import cupy
+    _HAS_CUPY = True
+except ImportError:
+    # cupy is optional, only needed for hurot(..., backend="cupy").
+    _HAS_CUPY = False
+
+try:
+    from threadpoolctl import threadpool_limits
+    _HAS_THREADPOOLCTL = True
+except ImportError:
+    # threadpoolctl is optional, only used to share the BLAS threads between the solves of sk_div.
+    _HAS_THREADPOOLCTL = False
+
+
+def _vexp(x, shift=0., out=None):
+    """
+    Elementwise exp(x - shift), evaluated by numexpr (multithreaded, VML-backed when available) if installed,
+    with numpy otherwise (which also dispatches to cupy for GPU arrays).
+    out (possibly x itself) receives the result if given.
+    """
+    if _HAS_NUMEXPR and isinstance(x, np.ndarray):
+        return numexpr.evaluate("exp(x - shift)", local_dict={"x": x, "shift": shift}, out=out)
+    if out is None:
+        return np.exp(x - shift)
+    np.subtract(x, shift, out=out)
+    return np.exp(out, out=out)
+
+
+# With backend="auto", problems with at least that many entries in the cost matrix are solved on GPU (with cupy).
+_CUPY_MIN_SIZE = 10 ** 6
+
+
+def _has_gpu():
+    """
+    Is cupy installed with at least one visible CUDA device? (backend="auto" falls back to numpy otherwise.)
+    """
+    if not _HAS_CUPY:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        # e.g. cupy wheel installed on a host without CUDA driver or device.
+        return False
+
+
+# Integer tags of the marginal divergences, used to dispatch aprox inside compiled kernels.
+_MODE_IDS = {"balanced": 0, "KL": 1, "TV": 2, "boundary": 3}
 
 
 def aprox(x, mode_divergence, eps=None, cdiag=None):
@@ -22,36 +107,171 @@ def aprox(x, mode_divergence, eps=None, cdiag=None):
                   where thediag is the boundary of our space.
     :return: output of LSE after performing aprox.
     """
-    if mode_divergence == "balanced":
-        return x
-    elif mode_divergence == "KL":
-        return x / (1 + eps)
-    elif mode_divergence == "TV":
-        return np.maximum(-1, np.minimum(x, 1))
-    elif mode_divergence == "boundary":
-        return np.maximum(-cdiag, x + eps * np.log(cdiag))
-    else:
+    if mode_divergence not in _APROX:
         raise ValueError("mode %s is not available for aprox" % mode_divergence)
+    return _APROX[mode_divergence](x, eps, cdiag)
 
 
 def varphi_star(q, mode_divergence, cdiag):
-    if mode_divergence == "balanced":
-        return q
-    elif mode_divergence == "KL":
-        return np.exp(q) - 1
-    elif mode_divergence == "TV":
-        return np.maximum(-1, q)
-    elif mode_divergence == "boundary":
-        return np.maximum(-1, np.divide(q, cdiag))
-    else:
+    if mode_divergence not in _VARPHI_STAR:
         raise ValueError("mode %s is not available for varphi_star" % mode_divergence)
+    return _VARPHI_STAR[mode_divergence](q, cdiag)
+
+
+# Implementations of aprox and varphi_star for each mode_divergence (a dict lookup instead of string comparisons).
+_APROX = {
+    "balanced": lambda x, eps, cdiag: x,
+    "KL": lambda x, eps, cdiag: x / (1 + eps),
+    "TV": lambda x, eps, cdiag: np.clip(x, -1, 1),
+    "boundary": lambda x, eps, cdiag: np.maximum(-cdiag, x + eps * np.log(cdiag)),
+}
+# Sign-folded versions, x -> -aprox(-x), as applied to the output of the Sinkhorn map (a single pass, no negation).
+_APROX_SIGNED = {
+    "balanced": lambda x, eps, cdiag: x,
+    "KL": lambda x, eps, cdiag: x / (1 + eps),
+    "TV": lambda x, eps, cdiag: np.clip(x, -1, 1),
+    "boundary": lambda x, eps, cdiag: np.minimum(cdiag, x - eps * np.log(cdiag)),
+}
+_VARPHI_STAR = {
+    "balanced": lambda q, cdiag: q,
+    "KL": lambda q, cdiag: np.exp(q) - 1,
+    "TV": lambda q, cdiag: np.maximum(-1, q),
+    "boundary": lambda q, cdiag: np.maximum(-1, np.divide(q, cdiag)),
+}
+
+
+@njit(inline='always')
+def _aprox_signed(r, mode_id, eps, cdiag, j):
+    """
+    -aprox(-r) for the j-th entry, inside compiled kernels (mode_id is given by _MODE_IDS): same as _APROX_SIGNED.
+    """
+    if mode_id == 1:  # KL
+        return r / (1 + eps)
+    elif mode_id == 2:  # TV
+        return min(max(r, -1.), 1.)
+    elif mode_id == 3:  # boundary
+        return min(cdiag[j], r - eps * np.log(cdiag[j]))
+    return r
+
+
+@njit(inline='always')
+def _lse_push(m, s, h, w, h_min):
+    """
+    Streaming weighted LogSumExp: adds the term w * exp(h) to the accumulator (m, s) representing m + log(s),
+    rescaling s when h becomes the running max. Returns the updated (m, s).
+    Exponents below h_min (relative to the max) are clamped to it: the term is then negligible anyway,
+    and exp never takes its (slow) underflow path.
+    """
+    if h > m:
+        return h, s * np.exp(m - h) + w
+    return m, s + w * np.exp(max(h - m, h_min))
+
+
+# Lower bound of the exponents in the compiled LogSumExp (see _lse_push): exp(-80) ~ 2e-35 is negligible in the sum,
+# and stays above the float32 underflow (~ exp(-87)).
+_LSE_H_MIN = -80.
+
+
+# Tiling of the compiled LogSumExp: rows of CT_eps are processed by blocks of _LSE_ROWS (one block per thread),
+# and the reduction by chunks of _LSE_COLS terms, so that the chunks of f_eps and a_norm (shared by the rows
+# of a block) stay in L1 cache.
+_LSE_ROWS = 32
+_LSE_COLS = 512
+
+
+@njit(fastmath=True, cache=True)
+def _lse_block(f_eps, CT_eps, a_norm, j0, j1, out):
+    """
+    Stabilized weighted LogSumExp over the rows j0, ..., j1 - 1 of CT_eps:
+        out_j = log sum_i a_norm_i exp(f_eps_i - CT_eps_ji)
+    Single pass over each row, with the streaming (running max, rescaled sum) accumulator of _lse_push.
+    The running max and the exponents are computed in the precision of f_eps and CT_eps,
+    the sum is accumulated in float64.
+    """
+    n = CT_eps.shape[1]
+    h_star = np.empty(j1 - j0, CT_eps.dtype)
+    s = np.zeros(j1 - j0)
+    h_min = CT_eps.dtype.type(_LSE_H_MIN)
+    for j in range(j0, j1):
+        h_star[j - j0] = f_eps[0] - CT_eps[j, 0]
+    for i0 in range(0, n, _LSE_COLS):
+        i1 = min(i0 + _LSE_COLS, n)
+        for j in range(j0, j1):
+            m, acc = h_star[j - j0], s[j - j0]
+            for i in range(i0, i1):
+                m, acc = _lse_push(m, acc, f_eps[i] - CT_eps[j, i], a_norm[i], h_min)
+            h_star[j - j0] = m
+            s[j - j0] = acc
+    for j in range(j0, j1):
+        out[j] = h_star[j - j0] + np.log(s[j - j0])
+
+
+# Compiled kernels specialized for each mode_divergence, built at first use by _make_kernels.
+_KERNELS = {}
+
+
+def _make_kernels(mode_divergence):
+    """
+    Build (once per mode_divergence) the compiled LogSumExp map specialized for this mode:
+    mode_id is a constant of the closure, so the aprox branch is folded away at compile time.
+    The homogeneity mode and the marginal correction only enter through the normalized weights.
+
+    :return: lse_map.
+    """
+    if mode_divergence not in _MODE_IDS:
+        raise ValueError("mode %s is not available for aprox" % mode_divergence)
+    if mode_divergence in _KERNELS:
+        return _KERNELS[mode_divergence]
+    mode_id = _MODE_IDS[mode_divergence]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def lse_map(f_eps, CT_eps, a_norm, eps, cdiag):
+        """
+        Fused version of the stabilized LogSumExp in sinkhorn_map: streams CT_eps (by tiles)
+        without materializing the (n x m) matrices h and exp(h - h_star), and applies the (sign-folded)
+        aprox operator -aprox(-res) in the same pass.
+
+        :param f_eps: dual potential divided by eps, size n.
+        :param CT_eps: transposed cost matrix divided by eps, size (m x n) (rows are reduced).
+        :param cdiag: distance to the boundary of the m points (only read in "boundary" mode).
+        :return: array of size m.
+        """
+        m = CT_eps.shape[0]
+        res = np.empty(m)
+        for jb in prange((m + _LSE_ROWS - 1) // _LSE_ROWS):
+            j0, j1 = jb * _LSE_ROWS, min((jb + 1) * _LSE_ROWS, m)
+            _lse_block(f_eps, CT_eps, a_norm, j0, j1, res)
+            for j in range(j0, j1):
+                res[j] = _aprox_signed(- eps * res[j], mode_id, eps, cdiag, j)
+        return res
+
+    _KERNELS[mode_divergence] = lse_map
+    return lse_map
+
+
+def normalized_weights(a, b, mode_homogeneity, corrected_marginals):
+    """
+    Weights used in the LogSumExp of the Sinkhorn map of the measure a (b being the other measure).
+    """
+    # We Run Sinkhorn algorithm for renormalized version of the measure.
+    # Idea: Sinkhorn loop is processed with a * X/Y, where X is the renormalization applied on exp(f+g-c)
+    #       and Y is the normalization applied to the marginals.
+    # Therefore, if we apply (harmonic or geometric) homogeneity, X = sqrt(m(a)*m(b))
+    #        and if we apply marginal correction, Y = sqrt(m(a) / m(b))
+    # Hence,  X / Y = 1/np.sum(a)  (or np.sum(b)) for the matter.
+    if mode_homogeneity == "std":
+        return a
+    if corrected_marginals:
+        return a / np.sum(a)
+    return a / np.sqrt(np.sum(a) * np.sum(b))
 
 
 def sinkhorn_map(f, a,
                  mode_divergence, mode_homogeneity,
                  corrected_marginals,
-                 eps, cost_matrix, cdiag,
-                 stab, b=None):
+                 eps, cost_matrix_eps, cdiag,
+                 stab, b=None, return_kernel=False, cost_matrix_eps_T=None, out_h=None, a_norm=None,
+                 aprox_signed_fn=None):
     """
         :param f: current eval of dual potential, same shape as mu (say n)
         :param a: distribution of weights of the measure (histogram)
@@ -59,47 +279,61 @@ def sinkhorn_map(f, a,
         :param mode_homogeneity: Are we in std model (no homogeneity) or homogene (L or G) one?
         :param corrected_marginals: Should we use the corrected version of the marginals.
         :param eps: smoothing param
-        :param cost_matrix: cost matrix, size (n x m)
+        :param cost_matrix_eps: cost matrix divided by eps, size (n x m)
         :param cdiag: distance to the boundary (throwing cost).
         :param stab: boolean, should we use stabilized log-sum-exp version of the implementation.
         :param b: the second measure, useful for some homogene model only.
+        :param return_kernel: if True, also return the kernel matrix exp((f(+)res)/eps - cost_matrix_eps), size (n x m),
+                              obtained by rescaling the exponential computed in the LogSumExp.
+        :param cost_matrix_eps_T: (optional) contiguous copy of cost_matrix_eps.T, size (m x n),
+                                  used by the compiled LogSumExp to read rows with unit stride.
+        :param out_h: (optional) scratch buffer of size (n x m), overwritten by the LogSumExp computed with numpy.
+                      If return_kernel, the returned kernel matrix is stored in it.
+        :param a_norm: (optional) normalized_weights(a, b, ...), if already computed (it is loop invariant).
+        :param aprox_signed_fn: (optional) _APROX_SIGNED[mode_divergence], if already resolved.
 
         Note: warning, will need a C.T when applying on g
     """
-    h = (f[:, None] - cost_matrix) / eps
-    # We Run Sinkhorn algorithm for renormalized version of the measure.
-    # Idea: Sinkhorn loop is processed with a * X/Y, where X is the renormalization applied on exp(f+g-c)
-    #       and Y is the normalization applied to the marginals.
-    # Therefore, if we apply (harmonic or geometric) homogeneity, X = sqrt(m(a)*m(b))
-    #        and if we apply marginal correction, Y = sqrt(m(a) / m(b))
-    # Hence,  X / Y = 1/np.sum(a)  (or np.sum(b)) for the matter.
+    if a_norm is None:
+        a_norm = normalized_weights(a, b, mode_homogeneity, corrected_marginals)
 
-    if mode_homogeneity == "std":
-        a_norm = a
-    else:
-        if corrected_marginals:
-            a_norm = a / np.sum(a)
-        else:
-            a_norm = a / np.sqrt(np.sum(a) * np.sum(b))
+    if aprox_signed_fn is None:
+        if mode_divergence not in _APROX_SIGNED:
+            raise ValueError("mode %s is not available for aprox" % mode_divergence)
+        aprox_signed_fn = _APROX_SIGNED[mode_divergence]
 
     # Computation of the LogSumExp
-    if stab:
-        h_star = np.max(h, axis=0)
-        tmp = (np.exp(h - h_star).T).dot(a_norm)
-        res = - eps * (h_star + np.log(tmp))
-    else:
-        tmp = (np.exp(h).T).dot(a_norm)
-        res = - eps * np.log(tmp)
-    # Apply the aprox operator and return.
-    return -aprox(-res, mode_divergence=mode_divergence, eps=eps, cdiag=cdiag)
+    # With numba, LSE and aprox are fused in a single compiled pass (cost_matrix_eps.T rows are reduced).
+    f_eps = f / eps
+    if stab and _HAS_NUMBA and not return_kernel and isinstance(f_eps, np.ndarray):
+        lse_map = _make_kernels(mode_divergence)
+        if cost_matrix_eps_T is None:
+            cost_matrix_eps_T = cost_matrix_eps.T
+        # If the cost is stored in float32, so are the running max and the exponents (but not the accumulation).
+        f_eps = f_eps.astype(cost_matrix_eps_T.dtype, copy=False)
+        cdiag = np.empty(0) if cdiag is None else cdiag
+        return lse_map(f_eps, cost_matrix_eps_T, a_norm, float(eps), cdiag)
+
+    h = np.subtract(f_eps[:, None], cost_matrix_eps, out=out_h)
+    h_star = np.max(h, axis=0) if stab else 0.
+    exp_h = _vexp(h, h_star, out=h)
+    tmp = (exp_h.T).dot(a_norm)
+    # Apply the aprox operator (sign-folded: -aprox(-res)) and return.
+    res = aprox_signed_fn(- eps * (h_star + np.log(tmp)), eps, cdiag)
+    if return_kernel:
+        # exp((f(+)res - C)/eps) = exp(h - h_star) * exp(res/eps + h_star): only m new exponentials.
+        exp_h *= np.exp(res / eps + h_star)
+        return res, exp_h
+    return res
 
 
 def update(first_potential, second_potential,
            first_weights, second_weights,
            mode_divergence, mode_homogeneity,
            corrected_marginals,
-           eps, C, cdiag1, cdiag2,
-           stab):
+           eps, C_eps, cdiag1, cdiag2,
+           stab, return_kernel=False, CT_eps=None, buffers=(None, None), weights_norm=(None, None),
+           aprox_signed_fn=None):
     """
     Update of the dual potential (iteration of the Sinkhorn algorithm) :
         f_{t+1} = sinkhorn_map(g_t, **hyperparams).
@@ -113,39 +347,122 @@ def update(first_potential, second_potential,
     :param mode_homogeneity: "std" (non-homogene), "harmonic" or "geometric".
     :param corrected_marginals: Boolean, should we apply the marginal renormalization.
     :param eps: the entropic regularization parameter.
-    :param C: Distance matrix between the points in the "first" measure and the "second" one. Beware of transpositions.
+    :param C_eps: Distance matrix between the points in the "first" measure and the "second" one, divided by eps.
+                  Beware of transpositions.
     :param cdiag1: distance to diagonal of elements in the "first" measure.
     :param cdiag2: distance to diagonal of elements in the "second" measure.
     :param stab: used stabilized version of LogSumExp (Sinkhorn) update (should be True).
+    :param return_kernel: if True, also return the kernel matrix exp((f_{t+1}(+)g_{t+1}-C)/eps) (n x m),
+                          to be reused in estim_dual.
+    :param CT_eps: (optional) contiguous copy of C_eps.T, so that both half-steps read the cost with unit stride.
+    :param buffers: (optional) scratch buffers of size (m x n) and (n x m), reused by the two half-steps
+                    (see out_h in sinkhorn_map).
+    :param weights_norm: (optional) normalized first and second weights (see a_norm in sinkhorn_map).
+    :param aprox_signed_fn: (optional) _APROX_SIGNED[mode_divergence], if already resolved.
     """
+    if CT_eps is None:
+        CT_eps = C_eps.T
+    if stab and _HAS_NUMBA and not return_kernel and isinstance(second_potential, np.ndarray):
+        # Both half-steps directly call the compiled LogSumExp map specialized for mode_divergence.
+        lse_map = _make_kernels(mode_divergence)
+        a_norm, b_norm = weights_norm
+        if a_norm is None:
+            a_norm = normalized_weights(first_weights, second_weights, mode_homogeneity, corrected_marginals)
+        if b_norm is None:
+            b_norm = normalized_weights(second_weights, first_weights, mode_homogeneity, corrected_marginals)
+        cdiag1 = np.empty(0) if cdiag1 is None else cdiag1
+        cdiag2 = np.empty(0) if cdiag2 is None else cdiag2
+        # The running max and the exponents are computed in the precision of the cost matrix (see _lse_block).
+        new_f = lse_map((second_potential / eps).astype(C_eps.dtype, copy=False), C_eps, b_norm, float(eps), cdiag1)
+        new_g = lse_map((new_f / eps).astype(CT_eps.dtype, copy=False), CT_eps, a_norm, float(eps), cdiag2)
+        return new_f, new_g
     new_f = sinkhorn_map(second_potential, second_weights,
                          mode_divergence=mode_divergence,
                          mode_homogeneity=mode_homogeneity,
                          corrected_marginals=corrected_marginals,
                          eps=eps,
-                         cost_matrix=C.T, cdiag=cdiag1,
-                         stab=stab, b=first_weights)
+                         cost_matrix_eps=CT_eps, cost_matrix_eps_T=C_eps, cdiag=cdiag1,
+                         stab=stab, b=first_weights, out_h=buffers[0], a_norm=weights_norm[1],
+                         aprox_signed_fn=aprox_signed_fn)
     new_g = sinkhorn_map(new_f, first_weights,
                          mode_divergence=mode_divergence,
                          mode_homogeneity=mode_homogeneity,
                          corrected_marginals=corrected_marginals,
-                         eps=eps, cost_matrix=C, cdiag=cdiag2,
-                         stab=stab, b=second_weights)
+                         eps=eps, cost_matrix_eps=C_eps, cost_matrix_eps_T=CT_eps, cdiag=cdiag2,
+                         stab=stab, b=second_weights,
+                         return_kernel=return_kernel, out_h=buffers[1], a_norm=weights_norm[0],
+                         aprox_signed_fn=aprox_signed_fn)
+    if return_kernel:
+        new_g, K = new_g
+        return new_f, new_g, K
     return new_f, new_g
 
 
+def _jax_aprox(x, mode_divergence, eps, cdiag):
+    """
+    jax version of _APROX_SIGNED (-aprox(-x, ...)).
+    """
+    if mode_divergence == "balanced":
+        return x
+    elif mode_divergence == "KL":
+        return x / (1 + eps)
+    elif mode_divergence == "TV":
+        return jnp.clip(x, -1, 1)
+    elif mode_divergence == "boundary":
+        return jnp.minimum(cdiag, x - eps * jnp.log(cdiag))
+    else:
+        raise ValueError("mode %s is not available for aprox" % mode_divergence)
+
+
+def _sinkhorn_scan(f, g, a_norm, b_norm, C_eps, eps, cdiag1, cdiag2, mode_divergence, nb):
+    """
+    Run nb (stabilized) Sinkhorn updates as a single jax.lax.scan (jitted below, when jax is available).
+    a_norm and b_norm are the weights given by normalized_weights.
+
+    :return: f, g after nb steps, and the relative change of f at each step (array of size nb).
+    """
+    def step(potentials, _):
+        f, g = potentials
+        new_f = - eps * jax_logsumexp(g[None, :] / eps - C_eps, axis=1, b=b_norm[None, :])
+        new_f = _jax_aprox(new_f, mode_divergence, eps, cdiag1)
+        new_g = - eps * jax_logsumexp(new_f[:, None] / eps - C_eps, axis=0, b=a_norm[:, None])
+        new_g = _jax_aprox(new_g, mode_divergence, eps, cdiag2)
+        delta = jnp.linalg.norm(new_f - f) / jnp.maximum(jnp.linalg.norm(new_f), 1e-30)
+        return (new_f, new_g), delta
+
+    (f, g), deltas = jax.lax.scan(step, (f, g), None, length=nb)
+    return f, g, deltas
+
+
+if _HAS_JAX:
+    _sinkhorn_scan = jax.jit(_sinkhorn_scan, static_argnames=("mode_divergence", "nb"))
+
+
 def estim_dual(first_potential, second_potential,
                first_weights, second_weights,
                mode_divergence, mode_homogeneity,
                corrected_marginals,
-               eps, C, cdiag1, cdiag2,
-               withentropy):
+               eps, C_eps, cdiag1, cdiag2,
+               withentropy, K_precomputed=None, masses=None, varphi_star_fn=None):
     """
     Dual estimation
     <-varphi_star(-f) , a> + <-varphi_star(-g), b> - eps < exp((f(+)g-C)/eps)-1, a (x) b>
+
+    C_eps is the cost matrix divided by eps.
+
+    If given, K_precomputed = exp((f(+)g-C)/eps) (as returned by update) is used instead of recomputing it,
+    and masses = (m(a), m(b)) instead of summing the weights,
+    and varphi_star_fn = _VARPHI_STAR[mode_divergence] instead of resolving the mode.
     """
+    if varphi_star_fn is None:
+        if mode_divergence not in _VARPHI_STAR:
+            raise ValueError("mode %s is not available for varphi_star" % mode_divergence)
+        varphi_star_fn = _VARPHI_STAR[mode_divergence]
+
     # Masses of the measures
-    ma, mb = np.sum(first_weights), np.sum(second_weights)
+    if masses is None:
+        masses = np.sum(first_weights), np.sum(second_weights)
+    ma, mb = masses
     # Geometric mean of the masses
     m_g = np.sqrt(ma * mb)
     # (Inverted) harmonic mean of the masses
@@ -155,34 +472,35 @@ def estim_dual(first_potential, second_potential,
 
     # Term corresponding to transport + marginal error
     if corrected_marginals:
-        z = np.dot(-varphi_star(-first_potential, mode_divergence, cdiag=cdiag1), first_weights * r_ab) \
-            + np.dot(-varphi_star(-second_potential, mode_divergence, cdiag=cdiag2), second_weights / r_ab)
+        z = np.dot(-varphi_star_fn(-first_potential, cdiag1), first_weights * r_ab) \
+            + np.dot(-varphi_star_fn(-second_potential, cdiag2), second_weights / r_ab)
     else:
-        z = np.dot(-varphi_star(-first_potential, mode_divergence, cdiag=cdiag1), first_weights) \
-            + np.dot(-varphi_star(-second_potential, mode_divergence, cdiag=cdiag2), second_weights)
+        z = np.dot(-varphi_star_fn(-first_potential, cdiag1), first_weights) \
+            + np.dot(-varphi_star_fn(-second_potential, cdiag2), second_weights)
     if not withentropy:
         return z
     # Term corresponding to the entropic regularization.
     else:
-        tmp1 = (np.add(first_potential[:, None], second_potential[None, :]) - C) / eps
+        if K_precomputed is None:
+            tmp1 = np.add(first_potential[:, None] / eps, second_potential[None, :] / eps) - C_eps
+            K = _vexp(tmp1, out=tmp1)
+        else:
+            K = K_precomputed
 
+        # <K, a (x) b> computed with two matrix-vector products (the outer product a (x) b is never formed),
+        # and <1, a (x) b> = m(a) * m(b).
+        tmp2 = np.dot(first_weights, K.dot(second_weights))
+
+        # Dot product entropic term
         if mode_homogeneity == 'std':
-            tmp2 = np.exp(tmp1) - 1
-            tmp2bis = np.multiply(first_weights[:, None], second_weights[None, :])
+            tmp3 = tmp2 - ma * mb
         elif mode_homogeneity == 'harmonic':
-
-            tmp2 = np.exp(tmp1) / m_g - m_h_inv
-            tmp2bis = np.multiply(first_weights[:, None], second_weights[None, :])
+            tmp3 = tmp2 / m_g - m_h_inv * ma * mb
         elif mode_homogeneity == "geometric":
-            m_g = np.sqrt(np.sum(first_weights) * np.sum(second_weights))
-            tmp2 = np.exp(tmp1) - 1
-            tmp2bis = np.multiply(first_weights[:, None], second_weights[None, :]) / m_g
+            tmp3 = (tmp2 - ma * mb) / m_g
         else:
             raise ValueError("mode_homogeneity %s unknown" % mode_homogeneity)
 
-        # Dot product entropic term
-        tmp3 = np.sum(np.multiply(tmp2, tmp2bis))
-
         # Summing everything to get the dual.
         return z - eps * tmp3
 
@@ -193,7 +511,8 @@ def hurot(X, Y, a, b,
        corrected_marginals,
        eps,
        nb_step=10000, crit=0.0001,
-       stab=True, verbose=1, init="unif", withentropy=True):
+       stab=True, verbose=1, init="unif", withentropy=True, check_every=10,
+       backend="numpy", cost_dtype="float64"):
     """
     Iterate Sinkhorn loop until convergence, between two measures
     $$alpha = sum_i a_i delta_{X_i}$$
@@ -209,16 +528,46 @@ def hurot(X, Y, a, b,
     :param corrected_marginals: Should we use the corrected version of the marginals (should be False).
     :param eps: Regularization parameter for the entropic smoothing.
     :param nb_step: Maximal number of step in the Sinkhorn Loop.
-    :param crit: Stopping criterion : relative error of change in the dual estimation.
+    :param crit: Stopping criterion : relative change of the dual potential f (for 3 consecutive steps),
+                 or relative error of change in the dual estimation (between two evaluations).
                     WARNING : when the pbm is not homogeneous, yield different convergence rates!
     :param stab: Should we use log-sum-exp stabilisation trick.
     :param verbose: 0: silent, 1: ok, 2: verbose.
     :param init: Mode to initialize the dual potentials (default: unif).
     :param withentropy: Do we keep entropic term in eval of dual (should be True).
+    :param check_every: Evaluate the dual (and its stopping criterion) every check_every steps only.
+    :param backend: "numpy", "jax", "cupy" or "auto".
+                    With "jax", the check_every steps between two evaluations of the dual are run as a single
+                    jitted jax.lax.scan (possibly on GPU), always stabilized, and in the default jax precision
+                    (float32 unless jax_enable_x64 is set).
+                    With "cupy", the same numpy code runs on GPU arrays, and the GPU is only synchronized every
+                    check_every steps.
+                    "auto" picks "cupy" when it is installed with a visible GPU and the cost matrix has
+                    at least 1e6 entries, "numpy" otherwise.
+    :param cost_dtype: dtype used to store the cost matrix in the iterations. With "float32", the compiled
+                       LogSumExp reads half the memory and computes its running max and exponents in float32
+                       (still accumulating in float64), at the price of a lower accuracy (relative error ~1e-7).
+                       The numpy LogSumExp (without numba, and at the steps evaluating the dual) still computes
+                       in float64: there, float32 only halves the storage of the cost.
 
     :return: P,f,g,e : Final transport plan, dual potentials, and objective value.
     """
-    C = ot.utils.dist(X, Y)
+    if check_every < 1:
+        raise ValueError("check_every (%s) should be at least 1." % check_every)
+    # The divergence is resolved once, the iterations call its aprox and varphi_star directly.
+    if mode_divergence not in _APROX_SIGNED:
+        raise ValueError("mode %s is not available for aprox" % mode_divergence)
+    aprox_signed_fn, varphi_star_fn = _APROX_SIGNED[mode_divergence], _VARPHI_STAR[mode_divergence]
+    # Loop invariant: the Sinkhorn iterations only use the cost divided by eps.
+    # (The float64 cost itself is not kept during the iterations, P is built from a recomputed one.)
+    C_eps = squared_dist(X, Y)
+    C_eps *= 1. / eps
+    C_eps = C_eps.astype(cost_dtype, copy=False)
+    # Contiguous transpose (not a strided view), so that both half-steps read the cost with unit stride.
+    CT_eps = np.ascontiguousarray(C_eps.T)
+    # Scratch buffers of the numpy LogSumExp, allocated once for all iterations
+    # (np.empty does not touch the memory, so they cost nothing if the compiled kernels are used).
+    buffers = (np.empty(CT_eps.shape), np.empty(C_eps.shape))
     if mode_divergence == "boundary":
         cdiag1 = squared_dist_to_diag(X)
         cdiag2 = squared_dist_to_diag(Y)
@@ -237,35 +586,91 @@ def hurot(X, Y, a, b,
         print("Unknown init. Pick rand.")
         f, g = np.random.rand(len(X)), np.random.rand(len(Y))
 
+    # Loop invariants: masses and normalized weights used in the LogSumExp.
+    masses = float(np.sum(a_weighted)), float(np.sum(b_weighted))
+    a_norm = normalized_weights(a_weighted, b_weighted, mode_homogeneity, corrected_marginals)
+    b_norm = normalized_weights(b_weighted, a_weighted, mode_homogeneity, corrected_marginals)
+
+    if backend == "auto":
+        backend = "cupy" if C_eps.size >= _CUPY_MIN_SIZE and _has_gpu() else "numpy"
+    if backend == "jax":
+        if not _HAS_JAX:
+            raise ImportError("backend 'jax' requires jax to be installed.")
+        jax_args = dict(a_norm=jnp.asarray(a_norm), b_norm=jnp.asarray(b_norm),
+                        C_eps=jnp.asarray(C_eps), eps=eps,
+                        cdiag1=None if cdiag1 is None else jnp.asarray(cdiag1),
+                        cdiag2=None if cdiag2 is None else jnp.asarray(cdiag2),
+                        mode_divergence=mode_divergence)
+    elif backend == "cupy":
+        if not _HAS_CUPY:
+            raise ImportError("backend 'cupy' requires cupy to be installed.")
+        # Everything used in the iterations is moved once to the GPU (numpy functions then dispatch to cupy).
+        C_eps, CT_eps, a_weighted, b_weighted, a_norm, b_norm, f, g = (
+            cupy.asarray(x) for x in (C_eps, CT_eps, a_weighted, b_weighted, a_norm, b_norm, f, g))
+        cdiag1, cdiag2 = (None if x is None else cupy.asarray(x) for x in (cdiag1, cdiag2))
+        buffers = (cupy.empty(CT_eps.shape), cupy.empty(C_eps.shape))
+    elif backend != "numpy":
+        raise ValueError("backend %s unknown." % backend)
+
     e = -np.inf
     converged = False
-    for t in range(nb_step):
-        f, g = update(first_potential=f, second_potential=g,
-                      first_weights=a_weighted, second_weights=b_weighted,
-                      mode_divergence=mode_divergence,
-                      mode_homogeneity=mode_homogeneity,
-                      corrected_marginals=corrected_marginals,
-                      eps=eps, C=C,
-                      cdiag1=cdiag1, cdiag2=cdiag2,
-                      stab=stab)
+    nb_small_steps = 0
+    t = 0
+    while t < nb_step:
+        # Number of steps until the next evaluation of the dual (1 with numpy, which checks f at each step).
+        nb = min(check_every - t % check_every, nb_step - t) if backend != "numpy" else 1
+        check = (t + nb) % check_every == 0 or t + nb == nb_step
+        t += nb
+        # When the entropic term is needed, the kernel matrix of the last half-step is reused in estim_dual.
+        K = None
+        if backend == "jax":
+            f, g, deltas = _sinkhorn_scan(jnp.asarray(f), jnp.asarray(g), nb=nb, **jax_args)
+            f, g, deltas = np.asarray(f, dtype=float), np.asarray(g, dtype=float), np.asarray(deltas)
+        else:
+            deltas = []
+            for k in range(nb):
+                return_kernel = withentropy and check and k == nb - 1
+                f_prev = f
+                out = update(first_potential=f, second_potential=g,
+                             first_weights=a_weighted, second_weights=b_weighted,
+                             mode_divergence=mode_divergence,
+                             mode_homogeneity=mode_homogeneity,
+                             corrected_marginals=corrected_marginals,
+                             eps=eps, C_eps=C_eps, CT_eps=CT_eps,
+                             cdiag1=cdiag1, cdiag2=cdiag2,
+                             stab=stab, return_kernel=return_kernel, buffers=buffers,
+                             weights_norm=(a_norm, b_norm), aprox_signed_fn=aprox_signed_fn)
+                if return_kernel:
+                    f, g, K = out
+                else:
+                    f, g = out
+                # (kept on the device with cupy, only read after the nb steps)
+                deltas.append(np.linalg.norm(f - f_prev) / np.maximum(np.linalg.norm(f), 1e-30))
+
+        # Cheap stopping criterion, tested at each step: relative change of f.
+        for delta in deltas:
+            nb_small_steps = nb_small_steps + 1 if delta < crit else 0
+        converged = nb_small_steps >= 3
+        # The dual estimation (O(nm)) is only computed every check_every steps, and when stopping.
+        if not (check or converged):
+            continue
 
         new_e = estim_dual(first_potential=f, second_potential=g,
                            first_weights=a_weighted, second_weights=b_weighted,
                            mode_divergence=mode_divergence,
                            mode_homogeneity=mode_homogeneity,
                            corrected_marginals=corrected_marginals,
-                           eps=eps, C=C,
+                           eps=eps, C_eps=C_eps,
                            cdiag1=cdiag1, cdiag2=cdiag2,
-                           withentropy=withentropy)
+                           withentropy=withentropy, K_precomputed=K, masses=masses,
+                           varphi_star_fn=varphi_star_fn)
 
-        if abs((new_e - e) / new_e) < crit:
-            e = new_e
-            converged = True
+        converged = converged or abs((new_e - e) / new_e) < crit
+        e = new_e
+        if converged:
             if verbose >= 1:
-                print("converged at step t =", t)
+                print("converged at step t =", t - 1)
             break
-        else:
-            e = new_e
 
     if not converged:
         if crit > 0:
@@ -274,18 +679,92 @@ def hurot(X, Y, a, b,
         else:
             if verbose >= 1:
                 print("(note: convergence criterion is 0. Ran the algorithm for %s steps)" % nb_step)
-    P = get_P(f, g, a_weighted, b_weighted, eps, C, mode_homogeneity=mode_homogeneity)
+    if backend == "cupy":
+        f, g, a_weighted, b_weighted = (cupy.asnumpy(x) for x in (f, g, a_weighted, b_weighted))
+        e = float(e)
+    # The arrays of the iterations are released before building P.
+    del C_eps, CT_eps, buffers
+    P = get_P(f, g, a_weighted, b_weighted, eps, squared_dist(X, Y), mode_homogeneity=mode_homogeneity)
 
     return P, f, g, e
 
 
+# Values of the self-transport terms of sk_div (mu-->mu), keyed by the content of (X, a) and the parameters.
+_SELF_COST_CACHE = OrderedDict()
+_SELF_COST_CACHE_SIZE = 128
+_SELF_COST_LOCK = threading.Lock()
+
+
+def _array_key(x):
+    x = np.ascontiguousarray(x)
+    return x.shape, x.dtype.str, hashlib.sha1(x).hexdigest()
+
+
+def _self_cost(X, a, **params):
+    """
+    Value of hurot(X, X, a, a, **params) (self entropy term of the Sinkhorn divergence), with a LRU cache:
+    measures that appear in several calls of sk_div are only solved once.
+    """
+    key = (_array_key(X), _array_key(a),
+           tuple(sorted((k, v) for k, v in params.items() if k != "verbose")))
+    # The lock only guards the cache (sk_div may call this from several threads), not the solve itself.
+    with _SELF_COST_LOCK:
+        if key in _SELF_COST_CACHE:
+            _SELF_COST_CACHE.move_to_end(key)
+            return _SELF_COST_CACHE[key]
+    value = hurot(X, X, a, a, **params)[-1]
+    with _SELF_COST_LOCK:
+        _SELF_COST_CACHE[key] = value
+        if len(_SELF_COST_CACHE) > _SELF_COST_CACHE_SIZE:
+            _SELF_COST_CACHE.popitem(last=False)
+    return value
+
+
+def _can_run_threads(stab, backend):
+    """
+    Can the solves of sk_div run in concurrent threads? The compiled (parallel) kernels, only used with
+    stab and the numpy backend, can only be called from several threads if numba uses a thread safe
+    threading layer (tbb or omp, not workqueue).
+    """
+    if not (_HAS_NUMBA and stab and backend in ("numpy", "auto")):
+        return True
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        # The threading layer is only chosen once a parallel kernel has run: run a tiny one.
+        _make_kernels("balanced")(np.zeros(1), np.zeros((1, 1)), np.ones(1), 1., np.empty(0))
+        layer = numba.threading_layer()
+    return layer != "workqueue"
+
+
+def _blas_limits(n_jobs):
+    """
+    Context sharing the BLAS threads between n_jobs concurrent solves (with threadpoolctl, if available),
+    to avoid oversubscription.
+    """
+    if not _HAS_THREADPOOLCTL:
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=max(1, (os.cpu_count() or 1) // n_jobs), user_api="blas")
+
+
+def _run_limited(solve, numba_threads):
+    """
+    Run solve() with at most numba_threads threads in the compiled kernels (numba's setting is thread local,
+    so it is set in the thread running the solve).
+    """
+    if _HAS_NUMBA:
+        numba.set_num_threads(numba_threads)
+    return solve()
+
+
 def sk_div(X, Y, a, b,
            mode_divergence,
            mode_homogeneity,
            corrected_marginals,
            eps,
            nb_step=1000, crit=0.0001,
-           stab=True, verbose=1, init="unif"):
+           stab=True, verbose=1, init="unif", check_every=10, backend="numpy", cost_dtype="float64",
+           cache_self=True, n_jobs=3):
     """
     Compute the Sinkhorn divergence between (possibly) unbalanced measures.
 
@@ -302,27 +781,39 @@ def sk_div(X, Y, a, b,
     :param stab: Should we use LSE stabilization.
     :param verbose: Verobisity level.
     :param init: Initialization of dual potentials.
+    :param check_every: Evaluate the dual every check_every steps only (see hurot).
+    :param backend: "numpy", "jax", "cupy" or "auto" (see hurot).
+    :param cost_dtype: "float64" or "float32", dtype of the cost matrix in the iterations (see hurot).
+    :param cache_self: Should we reuse the self entropy terms already computed for the same measure and parameters
+                       (see _self_cost).
+    :param n_jobs: Number of threads running the three (independent) transport problems concurrently
+                   (1 to run them sequentially, see _can_run_threads).
 
     :return: value of sinkhorn divergence.
     """
-    # Cost mu-->nu
-    xy = hurot(X, Y, a, b,
-               mode_divergence=mode_divergence, mode_homogeneity=mode_homogeneity,
-               corrected_marginals=corrected_marginals,
-               eps=eps, nb_step=nb_step, crit=crit,
-               stab=stab, verbose=verbose, init=init, withentropy=True)[-1]
-    # Cost mu-->mu (self entropy)
-    xx = hurot(X, X, a, a,
-               mode_divergence=mode_divergence, mode_homogeneity=mode_homogeneity,
-               corrected_marginals=corrected_marginals,
-               eps=eps, nb_step=nb_step, crit=crit,
-               stab=stab, verbose=verbose, init=init, withentropy=True)[-1]
-    # Cost nu-->nu (self entropy)
-    yy = hurot(Y, Y, b, b,
-               mode_divergence=mode_divergence, mode_homogeneity=mode_homogeneity,
-               corrected_marginals=corrected_marginals,
-               eps=eps, nb_step=nb_step, crit=crit,
-               stab=stab, verbose=verbose, init=init, withentropy=True)[-1]
+    params = dict(mode_divergence=mode_divergence, mode_homogeneity=mode_homogeneity,
+                  corrected_marginals=corrected_marginals,
+                  eps=eps, nb_step=nb_step, crit=crit,
+                  stab=stab, verbose=verbose, init=init, withentropy=True, check_every=check_every,
+                  backend=backend, cost_dtype=cost_dtype)
+    if cache_self:
+        self_cost = _self_cost
+    else:
+        def self_cost(Z, c, **params):
+            return hurot(Z, Z, c, c, **params)[-1]
+    # Cost mu-->nu, and mu-->mu and nu-->nu (self entropy).
+    solves = [lambda: hurot(X, Y, a, b, **params)[-1],
+              lambda: self_cost(X, a, **params),
+              lambda: self_cost(Y, b, **params)]
+    n_jobs = min(n_jobs, len(solves))
+    if n_jobs > 1 and _can_run_threads(stab, backend):
+        # The BLAS threads (process wide) and the numba threads (per solve) are shared between the solves.
+        numba_threads = max(1, numba.get_num_threads() // n_jobs) if _HAS_NUMBA else None
+        with _blas_limits(n_jobs), ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_run_limited, solve, numba_threads) for solve in solves]
+            xy, xx, yy = (future.result() for future in futures)
+    else:
+        xy, xx, yy = (solve() for solve in solves)
 
     cost_brut = xy - 0.5 * xx - 0.5 * yy
 
@@ -352,6 +843,31 @@ def sk_div(X, Y, a, b,
 ###########################
 
 
+def squared_dist(X, Y):
+    """
+    :param X: (n x d) array.
+    :param Y: (m x d) array.
+    :returns: (n x m) matrix of the squared Euclidean distances |X_i - Y_j|^2,
+              computed as |X_i|^2 + |Y_j|^2 - 2 <X_i, Y_j> (a single matrix product).
+    """
+    x2 = np.einsum('ij,ij->i', X, X)
+    y2 = np.einsum('ij,ij->i', Y, Y)
+    D = np.add(x2[:, None], y2[None, :])
+    D -= 2 * X.dot(Y.T)
+    # Clip the (tiny) negative values due to rounding errors.
+    return np.maximum(D, 0, out=D)
+
+
+def weighted_squared_dist(X, Y, a, b):
+    """
+    :returns: sum_ij a_i b_j |X_i - Y_j|^2, without building the (n x m) distance matrix:
+              <a, |X|^2> m(b) + m(a) <b, |Y|^2> - 2 <X^T a, Y^T b>.
+    """
+    return np.dot(a, np.einsum('ij,ij->i', X, X)) * np.sum(b) \
+        + np.sum(a) * np.dot(b, np.einsum('ij,ij->i', Y, Y)) \
+        - 2 * np.dot(X.T.dot(a), Y.T.dot(b))
+
+
 def squared_dist_to_diag(X):
     """
     :param X: (n x 2) array encoding the points of a persistent diagram.
@@ -369,11 +885,11 @@ def get_P(f, g, a, b, eps, C, mode_homogeneity):
     tmp2 = np.multiply(a[:, None], b[None, :])
 
     if mode_homogeneity == "std":
-        return np.multiply(np.exp(tmp1), tmp2)
+        return np.multiply(_vexp(tmp1), tmp2)
     elif mode_homogeneity == "geometric":
-        return np.multiply(np.exp(tmp1), tmp2) / np.sqrt(np.sum(a) * np.sum(b))
+        return np.multiply(_vexp(tmp1), tmp2) / np.sqrt(np.sum(a) * np.sum(b))
     elif mode_homogeneity == "harmonic":
-        return np.multiply(np.exp(tmp1), tmp2) / np.sqrt(np.sum(a) * np.sum(b))
+        return np.multiply(_vexp(tmp1), tmp2) / np.sqrt(np.sum(a) * np.sum(b))
     else:
         raise ValueError("mode_homogeneity (%s) unknown.")
 
@@ -390,12 +906,9 @@ def MMD(X, Y, a, b):
     :return: Value of MMD for the Euclidean cost.
     TODO: implement with general cost.
     """
-    Cxy = ot.utils.dist(X, Y)
-    Cxx = ot.utils.dist(X, X)
-    Cyy = ot.utils.dist(Y, Y)
-    r1 = np.dot(a, np.dot(Cxy, b))
-    r2 = np.dot(a, np.dot(Cxx, a))
-    r3 = np.dot(b, np.dot(Cyy, b))
+    r1 = weighted_squared_dist(X, Y, a, b)
+    r2 = weighted_squared_dist(X, X, a, a)
+    r3 = weighted_squared_dist(Y, Y, b, b)
     return r1 - 0.5 * r2 - 0.5 * r3
 
 
@@ -414,7 +927,8 @@ def plot_transport_plan(ax, xs, xt, P, thr=1e-8):
     :param thr: only draw edges in P above this threshold.
     """
     mx = np.max(P)
-    for i in range(xs.shape[0]):
-        for j in range(xt.shape[0]):
-            if P[i, j] / mx > thr:
-                ax.plot([xs[i, 0], xt[j, 0]], [xs[i, 1], xt[j, 1]], alpha=P[i, j] / mx, color='k')
+    # Select the edges above the threshold at once, only loop over those.
+    idx = np.argwhere(P > thr * mx)
+    alphas = P[idx[:, 0], idx[:, 1]] / mx
+    for (i, j), alpha in zip(idx, alphas):
+        ax.plot([xs[i, 0], xt[j, 0]], [xs[i, 1], xt[j, 1]], alpha=alpha, color='k')